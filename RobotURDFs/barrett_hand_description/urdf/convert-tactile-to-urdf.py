@@ -4,7 +4,7 @@ import numpy as np
 import rospy
 import roslib
 
-Pose = namedtuple('Pose', ['xyz', 'rpy'], verbose=True)
+Pose = namedtuple('Pose', ['xyz', 'rpy'])
 
 def get_pose_array(filter_array, palm, rpy=[0,0,0]):
 	pa = []
@@ -28,10 +28,10 @@ def get_pose_array(filter_array, palm, rpy=[0,0,0]):
 def get_path(package_name, resource_name):
     resources = roslib.packages.find_resource(package_name, resource_name)
     if len(resources) == 0:
-        rospy.logerr("Failed to find resource %s in package %s"%(resource_name, package_name))
+        rospy.logerr(f"Failed to find resource {resource_name} in package {package_name}")
         return ""
     else:
-		return resources[0]
+        return resources[0]
 
 tactile_filename = get_path('graspit', 'BarrettBH8_280_Tactile.xml')
 
@@ -11,14 +11,14 @@ import sys
 import pybullet as p
 from math import pi, sqrt
 import pybullet_data
-from time import sleep, time
+from time import sleep
 import astropy.coordinates
 import random
 from transforms3d import euler
 from configparser import ConfigParser
 from pyquaternion import Quaternion
 import numpy as np
-from scipy.spatial import ConvexHull, distance
+from scipy.spatial import ConvexHull
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(__file__))
 
@@ -75,6 +75,13 @@ def rand_coord():
     return rand_theta, rand_phi
 
 
+def sim_steps(seconds):
+    """
+    number of simulation steps that cover the given amount of simulated time
+    """
+    return int(round(seconds / p.getPhysicsEngineParameters()['fixedTimeStep']))
+
+
 def add_debug_lines(rID, line_dist=.3, line_width = 500):
     """
     Use pybullet's built-in line functionality to see the z/y/z coords of the hand
@@ -137,13 +144,17 @@ def hand_dist(oID, rID, pos, oren):
     # print("reset hand for non-fixed base")
     reset_hand(rID, rPos=pos, rOr=oren, fixed=False)
     relax(rID)  # want fingers splayed to get distance
-    force_vector = np.array(pos)*-speed_find_distance
+    # pybullet re-parses its vector args on every call, so hand it plain float tuples instead of numpy arrays
+    pos_t = tuple(float(c) for c in pos)
+    force_vector = tuple(-speed_find_distance*c for c in pos_t)
 
+    apply_force = p.applyExternalForce
+    get_contacts = p.getContactPoints
     has_contact = 0
     while not has_contact:  # while still distance between hand/object
-        p.applyExternalForce(rID, -1, force_vector, pos, p.WORLD_FRAME)
+        apply_force(rID, -1, force_vector, pos_t, p.WORLD_FRAME)
         p.stepSimulation()
-        has_contact = len(p.getContactPoints(rID, oID))
+        has_contact = len(get_contacts(rID, oID))
     t_pos, t_oren = p.getBasePositionAndOrientation(rID)
     clean_up(rID)
     return t_pos  # only need the position of the object
@@ -158,7 +169,7 @@ def adjust_point_dist(theta_rad, phi_rad, rID, oID, carts, quat):
     """
 
     t_pos = hand_dist(oID, rID, carts, quat)
-    t_dist = distance.euclidean(t_pos, [0,0,0])
+    t_dist = sqrt(t_pos[0]**2 + t_pos[1]**2 + t_pos[2]**2)
     m_dist = t_dist + grasp_distance_margin
     carts = astropy.coordinates.spherical_to_cartesian(m_dist, theta_rad, phi_rad)
     flip_carts = np.array(carts)*-1 #adjust to face obj
@@ -235,8 +246,9 @@ def wrist_rotations(pose):
     quat_z = quat[2]
     current_quat = Quaternion(quat_w, quat_x, quat_y, quat_z)
     rot_iter = (2*pi)/num_wrist_rotations
+    rot_axis = np.array(point)*-1
     for i in range(0, num_wrist_rotations):
-        rot_quat = Quaternion(axis=np.array(point)*-1, radians=(pi/2)+(rot_iter * i))
+        rot_quat = Quaternion(axis=rot_axis, radians=(pi/2)+(rot_iter * i))
         delta_quat = rot_quat * current_quat
         pyb_quat = (delta_quat[1], delta_quat[2], delta_quat[3], delta_quat[0])
         rotated_poses.append((point, pyb_quat))
@@ -255,23 +267,23 @@ def grasp(handId):
     this is based on time + not contact points because contact points could just be a finger poking the object
     relies on grip_joints - specified by user/config file which joints should close
     """
-    finish_time = time() + grasp_time_limit
-    while time() < finish_time:
+    target_velocities = [target_grasp_velocity]*len(active_grasp_joints)
+    forces = [max_grasp_force]*len(active_grasp_joints)
+    # motor targets persist across steps, so they only need to be sent once
+    p.setJointMotorControlArray(bodyUniqueId=handId, jointIndices=active_grasp_joints,
+                                controlMode=p.VELOCITY_CONTROL, targetVelocities=target_velocities,
+                                forces=forces)
+    for _ in range(sim_steps(grasp_time_limit)):
         p.stepSimulation()
-        for joint in active_grasp_joints:
-            p.setJointMotorControl2(bodyUniqueId=handId, jointIndex=joint, controlMode=p.VELOCITY_CONTROL,
-                                    targetVelocity=target_grasp_velocity, force=max_grasp_force)
 
 
 def relax(rID):
     """
     return all joints to neutral/furthest extended, based on urdf specification
     """
-    joint = 0
-    num = p.getNumJoints(rID)
-    while joint < num:
-        p.resetJointState(rID, jointIndex=joint, targetValue=0.0)
-        joint = joint + 1
+    reset_joint = p.resetJointState
+    for joint in range(p.getNumJoints(rID)):
+        reset_joint(rID, jointIndex=joint, targetValue=0.0)
 
 
 """#####################################################################################################################
@@ -301,10 +313,8 @@ class Grasp:
 
 def get_robot_config(rID, oID):
     r_pos, r_oren = p.getBasePositionAndOrientation(rID)
-    joints = {}
     num = p.getNumJoints(rID)
-    for joint in range(0, num):
-        joints[joint] = p.getJointState(rID, joint)
+    joints = dict(enumerate(p.getJointStates(rID, range(num))))
     o_pos, o_oren = p.getBasePositionAndOrientation(oID)
     vol, ep = grip_qual(rID,oID)
     return Grasp(r_pos, r_oren, joints, o_pos, o_oren, vol, ep)
@@ -322,24 +332,31 @@ def check_grip(oID, rID):
     #print("checking strength of current grip")
     mag = 1
     pos, oren = p.getBasePositionAndOrientation(rID)
+    grav_force = (0.0, 0.0, -float(mag))
     time_limit = .5
-    finish_time = time() + time_limit
-    p.addUserDebugText("Grav Check!", [-.07, .07, .07], textColorRGB=[0, 0, 1], textSize=1)
-    while time() < finish_time:
+    if debug_text:
+        # one text slot per check, updated in place so the hand's debug lines are left alone
+        text_id = p.addUserDebugText("Grav Check!", [-.07, .07, .07], textColorRGB=[0, 0, 1], textSize=1)
+    apply_force = p.applyExternalForce
+    for _ in range(sim_steps(time_limit)):
         p.stepSimulation()
-        p.applyExternalForce(oID, linkIndex=-1, forceObj=[0, 0, -mag], posObj=pos, flags=p.WORLD_FRAME)
+        apply_force(oID, linkIndex=-1, forceObj=grav_force, posObj=pos, flags=p.WORLD_FRAME)
     contact = p.getContactPoints(oID, rID)  # see if hand is still holding obj after gravity is applied
     if len(contact) > 0:
-        p.removeAllUserDebugItems()
-        p.addUserDebugText("Grav Check Passed!", [-.07, .07, .07], textColorRGB=[0, 1, 0], textSize=1)
         print("Grav Check Passed")
-        sleep(.2)
+        if debug_text:
+            p.addUserDebugText("Grav Check Passed!", [-.07, .07, .07], textColorRGB=[0, 1, 0], textSize=1,
+                               replaceItemUniqueId=text_id)
+            sleep(.2)  # only pause long enough to read the result
+            p.removeUserDebugItem(text_id)
         return get_robot_config(rID, oID)
     else:
-        p.removeAllUserDebugItems()
-        p.addUserDebugText("Grav Check Failed!", [-.07, .07, .07], textColorRGB=[1, 0, 0], textSize=1)
         print("Grav Check Failed")
-        sleep(.2)
+        if debug_text:
+            p.addUserDebugText("Grav Check Failed!", [-.07, .07, .07], textColorRGB=[1, 0, 0], textSize=1,
+                               replaceItemUniqueId=text_id)
+            sleep(.2)
+            p.removeUserDebugItem(text_id)
         return None
 
 
@@ -352,9 +369,10 @@ def grip_qual(oID, rID):
         force_torque = gws_pyramid_extension(rID, oID)
         #print("force_torque: ", force_torque)
         #print("force_torque shape: ", np.array(force_torque).shape)
-        vol = volume(force_torque)
+        hull = ConvexHull(points=force_torque)  # shared by both metrics
+        vol = hull_volume(hull)
         #print("volume: ", vol)
-        ep = eplison(force_torque)
+        ep = hull_eplison(hull)
         #print("eplison: ", ep)
     else:
         vol = None
@@ -411,20 +429,24 @@ def gws(rID, oID):
 def get_new_normals(force_vector, normal_force, sides, radius):
     """
     utility function to help with GWS/pyramid extension for contact points
+    works on one contact (force_vector (3,)) or a batch (force_vector (n, 3), normal_force (n,))
+    returns the pyramid vectors with shape (..., sides, 3)
     """
-    return_vectors = []
+    force_vector = np.asarray(force_vector)
     #get arbitrary vector to get cross product which should be orthogonal to both
-    vector_to_cross = np.array((force_vector[0]+1,force_vector[1]+2,force_vector[2]+3))
+    vector_to_cross = force_vector + (1, 2, 3)
     orthg = np.cross(force_vector, vector_to_cross)
-    orthg_vector = (orthg/np.linalg.norm(orthg))*radius
+    orthg_vector = (orthg/np.linalg.norm(orthg, axis=-1, keepdims=True))*radius
     rot_angle = (2*pi)/sides
-    split_force = normal_force/sides
+    split_force = np.asarray(normal_force)[..., np.newaxis, np.newaxis]/sides
 
-    for side_num in range(0,sides):
-        rotated_orthg = Quaternion(axis=force_vector, angle=(rot_angle*side_num)).rotate(orthg_vector)
-        new_vect = force_vector+np.array(rotated_orthg)
-        norm_vect = (new_vect/np.linalg.norm(new_vect))*split_force
-        return_vectors.append(norm_vect)
+    #orthg_vector is perpendicular to the axis, so rotating it about the axis reduces to cos/sin terms (rodrigues)
+    axis = force_vector/np.linalg.norm(force_vector, axis=-1, keepdims=True)
+    angles = (rot_angle*np.arange(sides))[:, np.newaxis]
+    rotated_orthg = np.cos(angles)*orthg_vector[..., np.newaxis, :] + \
+                    np.sin(angles)*np.cross(axis, orthg_vector)[..., np.newaxis, :]
+    new_vects = force_vector[..., np.newaxis, :] + rotated_orthg
+    return_vectors = (new_vects/np.linalg.norm(new_vects, axis=-1, keepdims=True))*split_force
 
     return return_vectors
 
@@ -434,22 +456,23 @@ def gws_pyramid_extension(rID, oID, pyramid_sides=force_pyramid_sides, pyramid_r
     local_frame_pos, max_radius = get_obj_info(oID)
     #sim uses center of mass as a reference for the Cartesian world transforms in getBasePositionAndOrientation
     obj_pos, obj_orn = p.getBasePositionAndOrientation(oID)
-    force_torque = []
     contact_points = p.getContactPoints(rID, oID)
-    for point in contact_points:
-        contact_pos = point[6]
-        normal_vector_on_obj = point[7]
-        normal_force_on_obj = point[9]
-        force_vector = np.array(normal_vector_on_obj)*normal_force_on_obj
-        if np.linalg.norm(force_vector) > 0:
-            new_vectors = get_new_normals(force_vector, normal_force_on_obj, pyramid_sides, pyramid_radius)
-
-            radius_to_contact = np.array(contact_pos) - np.array(obj_pos)
-
-            for pyramid_vector in new_vectors:
-                torque_numerator = np.cross(radius_to_contact, pyramid_vector)
-                torque_vector = torque_numerator/max_radius
-                force_torque.append(np.concatenate([pyramid_vector, torque_vector]))
+    # all contacts are extended in one batch: rows of contact_pos/normal_vector_on_obj line up with normal_force_on_obj
+    contact_pos = np.array([point[6] for point in contact_points]).reshape(-1, 3)
+    normal_vector_on_obj = np.array([point[7] for point in contact_points]).reshape(-1, 3)
+    normal_force_on_obj = np.array([point[9] for point in contact_points])
+    force_vector = normal_vector_on_obj*normal_force_on_obj[:, np.newaxis]
+    has_force = np.linalg.norm(force_vector, axis=1) > 0
+
+    new_vectors = get_new_normals(force_vector[has_force], normal_force_on_obj[has_force],
+                                  pyramid_sides, pyramid_radius).reshape(-1, 3)
+    radius_to_contact = np.repeat(contact_pos[has_force] - obj_pos, pyramid_sides, axis=0)
+
+    # one [fx, fy, fz, tx, ty, tz] row per pyramid side
+    force_torque = np.empty((len(new_vectors), 6))
+    force_torque[:, :3] = new_vectors
+    force_torque[:, 3:] = np.cross(radius_to_contact, new_vectors)
+    force_torque[:, 3:] /= max_radius
 
     return force_torque
 
@@ -459,8 +482,7 @@ def volume(force_torque):
     get qhull of the 6 dim vectors [fx, fy, fz, tx, ty, tz] created by gws (from contact points)
     get the volume
     """
-    vol = ConvexHull(points = force_torque)
-    return vol.volume
+    return hull_volume(ConvexHull(points=force_torque))
 
 
 def eplison(force_torque):
@@ -468,17 +490,22 @@ def eplison(force_torque):
     get qhull of the 6 dim vectors [fx, fy, fz, tx, ty, tz] created by gws (from contact points)
     get the distance from centroid of the hull to the closest vertex
     """
-    hull = ConvexHull(points=force_torque)
-    centroid = []
-    for dim in range(0,6):
-        centroid.append(np.mean(hull.points[hull.vertices, dim]))
-    shortest_distance = 500000000
-    closest_point = None
-    for point in force_torque:
-        point_dist = distance.euclidean(centroid, point)
-        if point_dist < shortest_distance:
-            shortest_distance = point_dist
-            closest_point = point
+    return hull_eplison(ConvexHull(points=force_torque))
+
+
+def hull_volume(hull):
+    """
+    volume of an already built qhull of the gws vectors
+    """
+    return hull.volume
+
+
+def hull_eplison(hull):
+    """
+    distance from centroid of an already built qhull of the gws vectors to the closest vertex
+    """
+    centroid = hull.points[hull.vertices].mean(axis=0)
+    shortest_distance = np.linalg.norm(hull.points - centroid, axis=1).min()
 
     return shortest_distance
 
@@ -505,20 +532,15 @@ good_grips = []
 
 pos = 0
 for pose in hand_set:
-    poses = []
-    poses.append(pose)
+    poses = [pose]
     if use_wrist_rotations:
-        rotated_poses = wrist_rotations(pose)
-        poses = poses + rotated_poses
+        poses.extend(wrist_rotations(pose))
 
     for pose in poses:
         print(" ")
         print("Pose #: ", pos)
         relax(rID)
-        p.removeAllUserDebugItems()
-        p.resetBasePositionAndOrientation(rID, pose[0], pose[1])
-        if debug_lines:
-            add_debug_lines(rID)
+        p.resetBasePositionAndOrientation(rID, pose[0], pose[1])  # debug lines are parented to rID and follow it
         oID = reset_ob(oID, [0, 0, 0], fixed=False)
         grasp(rID)
         vol, ep = grip_qual(oID, rID)